@@ -6,11 +6,24 @@
 ##    $ python client.py testdata/dog.jpg
 ##
 import sys
+import os
+import os.path
 import logging
 import time
 import selectors
 import socket
 import struct
+import tempfile
+
+
+##  BusyError
+##
+class BusyError(IOError):
+
+    def __init__(self, retry_after):
+        super().__init__(f'busy: retry_after={retry_after}')
+        self.retry_after = retry_after
+        return
 
 
 ##  RTSPClient
@@ -19,34 +32,66 @@ class RTSPClient:
 
     BUFSIZ = 65536
 
-    def __init__(self, host, port, path='detect'):
+    def __init__(self, host, port, path='detect', priority=None, fps=None, transport='udp'):
         self.logger = logging.getLogger()
         self.host = host
         self.port = port
         self.path = path
+        self.priority = priority
+        self.fps = fps
+        self.transport = transport
         self.sock_rtp = None
         self.sock_rtsp = None
+        self.sock_shm = None
+        self.shm = None
         self.session_id = None
         self.rtp_port = None
+        self._sent = {}
         return
 
     def open(self):
-        self.sock_rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock_rtp.setblocking(False)
-        self.sock_rtp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock_rtp.bind(('', 0))
-        (_, lport) = self.sock_rtp.getsockname()
+        if self.transport in ('tcp', 'shm'):
+            lport = self.transport
+        else:
+            self.sock_rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock_rtp.setblocking(False)
+            self.sock_rtp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock_rtp.bind(('', 0))
+            (_, lport) = self.sock_rtp.getsockname()
         self.logger.info(f'open: lport={lport}, host={self.host}, port={self.port}, path={self.path}')
         self.sock_rtsp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock_rtsp.connect((self.host, self.port))
         self.logger.info(f'open: connected.')
         req = f'FEED {lport} {self.path}'
+        if self.priority is not None:
+            req += f' priority={self.priority}'
+        if self.fps is not None:
+            req += f' fps={self.fps}'
         self.logger.debug(f'send: req={req!r}')
         self.sock_rtsp.send(req.encode('ascii')+b'\r\n')
         resp = self.sock_rtsp.recv(self.BUFSIZ)
         self.logger.debug(f'recv: resp={resp!r}')
+        if resp.startswith(b'!BUSY '):
+            # "!BUSY retry-after n"
+            f = resp.strip().split()
+            self.close()
+            raise BusyError(float(f[2]) if len(f) == 3 else 1.0)
         if not resp.startswith(b'+OK '): raise IOError(resp)
         f = resp[4:].strip().split()
+        self.selector = selectors.DefaultSelector()
+        self._recv_buf = b''
+        self._recv_seqno = 0
+        self._send_seqno = 1
+        if self.transport == 'tcp':
+            # Requests and responses are length-prefixed frames.
+            self.session_id = bytes.fromhex(f[1].decode('ascii'))
+            self.logger.info(f'open: tcp, session_id={self.session_id.hex()}')
+            self.sock_rtsp.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.fd = self.selector.register(self.sock_rtsp, selectors.EVENT_READ)
+            return
+        if self.transport == 'shm':
+            self.open_shm(f)
+            return
         try:
             self.rtp_port = int(f[0])
             self.session_id = bytes.fromhex(f[1].decode('ascii'))
@@ -57,16 +102,97 @@ class RTSPClient:
         # Send the dummy packet to initiate the stream.
         data = b'\x80\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
         self.sock_rtp.sendto(data, (self.host, self.rtp_port))
-        self.selector = selectors.DefaultSelector()
         self.fd = self.selector.register(self.sock_rtp, selectors.EVENT_READ)
-        self._recv_buf = b''
-        self._recv_seqno = 0
-        self._send_seqno = 1
         return
 
-    def request(self, reqid, threshold, data):
-        header = struct.pack('>4sLLL', b'JPEG', reqid, int(threshold*100), len(data))
-        self.send(header+data)
+    # open_shm: "+OK shm name nslots width height sockpath sessionId"
+    def open_shm(self, f):
+        from multiprocessing import shared_memory
+        import numpy as np
+        name = f[1].decode('ascii')
+        self.nslots = int(f[2])
+        (width, height) = (int(f[3]), int(f[4]))
+        sockpath = f[5].decode('utf-8')
+        self.session_id = bytes.fromhex(f[6].decode('ascii'))
+        self.logger.info(f'open: shm={name}, nslots={self.nslots}, sockpath={sockpath}, session_id={self.session_id.hex()}')
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # track is only supported in 3.13.
+            from multiprocessing import resource_tracker
+            self.shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        slot_size = 64 + height*width*3
+        self.reqids = [ np.ndarray((1,), dtype='<u4', buffer=self.shm.buf,
+                                   offset=i*slot_size)
+                        for i in range(self.nslots) ]
+        self.frames = [ np.ndarray((height,width,3), dtype=np.uint8, buffer=self.shm.buf,
+                                   offset=i*slot_size+64)
+                        for i in range(self.nslots) ]
+        self._slot = 0
+        self.sock_shm = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock_shm.bind(os.path.join(
+            tempfile.gettempdir(), f'fastdet-client-{self.session_id.hex()}.sock'))
+        self.sock_shm.connect(sockpath)
+        self.sock_shm.setblocking(False)
+        # Send an empty datagram to tell our address.
+        self.sock_shm.send(b'')
+        self.fd = self.selector.register(self.sock_shm, selectors.EVENT_READ)
+        return
+
+    def close(self):
+        if self.sock_shm is not None:
+            sockpath = self.sock_shm.getsockname()
+            self.sock_shm.close()
+            self.sock_shm = None
+            os.unlink(sockpath)
+        if self.shm is not None:
+            self.reqids = self.frames = None
+            self.shm.close()
+            self.shm = None
+        if self.sock_rtp is not None:
+            self.sock_rtp.close()
+            self.sock_rtp = None
+        if self.sock_rtsp is not None:
+            self.sock_rtsp.close()
+            self.sock_rtsp = None
+        return
+
+    # pack_filter: builds a request extension.
+    #   classes: list of class ids to detect, roi: (x, y, w, h) in pixels.
+    def pack_filter(self, classes=None, roi=None):
+        classes = classes or []
+        (x, y, w, h) = roi or (0, 0, 0, 0)
+        return struct.pack('>hhhhH', x, y, w, h, len(classes)) + bytes(classes)
+
+    # request_frame: puts a [H,W,3] uint8 image to the next slot (shm only).
+    def request_frame(self, reqid, threshold, frame, classes=None, roi=None):
+        slot = self._slot
+        self._slot = (slot+1) % self.nslots
+        # Invalidate the slot while it is being written.
+        self.reqids[slot][0] = 0
+        self.frames[slot][:] = frame
+        self.reqids[slot][0] = reqid
+        self._sent[reqid] = time.time()
+        if classes is None and roi is None:
+            req = struct.pack('>4sLLL', b'SHMF', reqid, int(threshold*100), slot)
+        else:
+            req = (struct.pack('>4sLLL', b'SHMX', reqid, int(threshold*100), slot) +
+                   self.pack_filter(classes, roi))
+        self.sock_shm.send(req)
+        return
+
+    def request(self, reqid, threshold, data, classes=None, roi=None):
+        if classes is None and roi is None:
+            header = struct.pack('>4sLLL', b'JPEG', reqid, int(threshold*100), len(data))
+        else:
+            header = (struct.pack('>4sLLL', b'JPGX', reqid, int(threshold*100), len(data)) +
+                      self.pack_filter(classes, roi))
+        self._sent[reqid] = time.time()
+        if self.transport == 'tcp':
+            self.sock_rtsp.sendall(struct.pack('>L', len(header)+len(data))+header+data)
+        else:
+            self.send(header+data)
         return
 
     def send(self, data, chunk_size=32768):
@@ -86,7 +212,17 @@ class RTSPClient:
     def idle(self, timeout=0):
         # Poll RTP ports.
         for (fd, ev) in self.selector.select(timeout):
-            if ev & selectors.EVENT_READ and fd == self.fd:
+            if ev & selectors.EVENT_READ and fd == self.fd and self.transport == 'tcp':
+                data = self.sock_rtsp.recv(self.BUFSIZ)
+                if not data: raise IOError('connection closed')
+                self.process_tcp(data)
+            elif ev & selectors.EVENT_READ and fd == self.fd and self.transport == 'shm':
+                while True:
+                    try:
+                        self.process_data(self.sock_shm.recv(self.BUFSIZ))
+                    except BlockingIOError:
+                        break
+            elif ev & selectors.EVENT_READ and fd == self.fd:
                 while True:
                     try:
                         (data, addr) = self.sock_rtp.recvfrom(self.BUFSIZ)
@@ -95,6 +231,15 @@ class RTSPClient:
                         break
         return
 
+    def process_tcp(self, data):
+        self._recv_buf += data
+        while 4 <= len(self._recv_buf):
+            (length,) = struct.unpack('>L', self._recv_buf[:4])
+            if len(self._recv_buf) < 4+length: break
+            self.process_data(self._recv_buf[4:4+length])
+            self._recv_buf = self._recv_buf[4+length:]
+        return
+
     def process_rtp(self, data):
         (flags,pt,seqno) = struct.unpack('>BBH', data[:4])
         self.logger.debug(
@@ -126,17 +271,23 @@ class RTSPClient:
                 '>BBhhhh', data[i:i+10])
             result.append((klass, conf, x, y, w, h))
             i += 10
-        self.logger.info(f'client: msec={msec}, reqid={reqid}, result={result}')
+        latency = 0
+        if reqid in self._sent:
+            latency = int((time.time() - self._sent[reqid])*1000)
+        # Discard the requests that will never be answered.
+        for k in [ k for k in self._sent if k <= reqid ]:
+            del self._sent[k]
+        self.logger.info(f'client: msec={msec}, latency={latency}, reqid={reqid}, result={result}')
         return
 
 # main
 def main(argv):
     import getopt
     def usage():
-        print(f'usage: {argv[0]} [-d] [-t interval] rtsp://host[:port]/path [file ...]')
+        print(f'usage: {argv[0]} [-d] [-t interval] [-P priority] [-F fps] [-T transport] [-C class,...] [-R x,y,w,h] rtsp://host[:port]/path [file ...]')
         return 100
     try:
-        (opts, args) = getopt.getopt(argv[1:], 'dt:')
+        (opts, args) = getopt.getopt(argv[1:], 'dt:P:F:T:C:R:')
     except getopt.GetoptError:
         return usage()
     level = logging.INFO
@@ -144,9 +295,19 @@ def main(argv):
     client_host = 'localhost'
     client_port = 10000
     threshold = 0.1
+    priority = None
+    fps = None
+    transport = 'udp'
+    classes = None
+    roi = None
     for (k, v) in opts:
         if k == '-d': level = logging.DEBUG
         elif k == '-t': interval = float(v)
+        elif k == '-P': priority = int(v)
+        elif k == '-F': fps = float(v)
+        elif k == '-T': transport = v
+        elif k == '-C': classes = [ int(c) for c in v.split(',') ]
+        elif k == '-R': roi = tuple( int(x) for x in v.split(',') )
     logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=level)
 
     if not args: return usage()
@@ -160,19 +321,43 @@ def main(argv):
         client_port = int(port)
 
     logging.info(f'connecting: {client_host}:{client_port}...')
-    client = RTSPClient(client_host, client_port, remotepath)
-    client.open()
+    if transport not in ('udp', 'tcp', 'shm'): return usage()
+    client = RTSPClient(client_host, client_port, remotepath,
+                        priority=priority, fps=fps, transport=transport)
+    while True:
+        try:
+            client.open()
+            break
+        except BusyError as e:
+            logging.info(f'busy: retrying after {e.retry_after}s...')
+            time.sleep(e.retry_after)
     files = []
     for path in args:
-        with open(path, 'rb') as fp:
-            files.append(fp.read())
+        if transport == 'shm':
+            import numpy as np
+            from PIL import Image
+            # Slots have the detector input size.
+            (height, width, _) = client.frames[0].shape
+            img = Image.open(path).convert('RGB').resize((width, height))
+            files.append(np.asarray(img))
+        else:
+            with open(path, 'rb') as fp:
+                files.append(fp.read())
     reqid = 0
-    while True:
-        for data in files:
-            reqid += 1
-            client.request(reqid, threshold, data)
-            client.idle()
-            time.sleep(interval)
+    try:
+        while True:
+            for data in files:
+                reqid += 1
+                if transport == 'shm':
+                    client.request_frame(reqid, threshold, data, classes=classes, roi=roi)
+                else:
+                    client.request(reqid, threshold, data, classes=classes, roi=roi)
+                # Keep polling until the next request so that latency is accurate.
+                deadline = time.time() + interval
+                while time.time() < deadline:
+                    client.idle(deadline - time.time())
+    finally:
+        client.close()
     return 0
 
 if __name__ == '__main__': sys.exit(main(sys.argv))
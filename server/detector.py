@@ -7,10 +7,17 @@ import sys
 import logging
 import numpy as np
 import time
-from math import exp
+import threading
+from collections import deque
+
+# Detection results: one record per object, (x, y) is the top left corner.
+RESULT_DTYPE = np.dtype([
+    ('klass', np.uint8), ('conf', np.float32),
+    ('x', np.float32), ('y', np.float32), ('w', np.float32), ('h', np.float32),
+])
 
 def sigmoid(x):
-    return 1/(1+exp(-x))
+    return 1/(1+np.exp(-x))
 
 def rect_intersect(rect0, rect1):
     (x0,y0,w0,h0) = rect0
@@ -21,11 +28,28 @@ def rect_intersect(rect0, rect1):
     h = min(y0+h0, y1+h1) - y
     return (x, y, w, h)
 
+# tile_positions: returns the offsets of overlapping tiles along an axis.
+def tile_positions(length, size, overlap):
+    if length <= size: return [0]
+    n = -(-(length-overlap) // (size-overlap))
+    return [ round(i*(length-size)/(n-1)) for i in range(n) ]
+
+# block_means: returns the mean of each n x n block of an [H,W,C] image.
+#   Rows are summed first; reducing both axes at once is much slower.
+def block_means(a, n=8):
+    (h, w, c) = a.shape
+    (h, w) = (h//n, w//n)
+    rows = a[:h*n, :w*n].reshape(h, n, w*n*c).sum(axis=1, dtype=np.uint16)
+    blocks = rows.reshape(h, w, n, c).sum(axis=2, dtype=np.uint16)
+    return blocks.astype(np.float32) / (n*n)
+
 
 ##  YOLOObject
 ##
 class YOLOObject:
 
+    __slots__ = ('klass', 'conf', 'bbox')
+
     def __init__(self, klass, conf, bbox):
         self.klass = klass
         self.conf = conf
@@ -42,21 +66,23 @@ class YOLOObject:
         return (w*h)/(w0*h0)
 
 # soft_nms: https://arxiv.org/abs/1704.04503
+#   objs: array of RESULT_DTYPE. Returns the selected objects.
 def soft_nms(objs, threshold):
+    (x, y, w, h) = ( objs[k].astype(np.float64) for k in 'xywh' )
+    conf = objs['conf'].astype(np.float64)
+    alive = np.ones(len(objs), dtype=bool)
     result = []
-    cands = { obj:obj.conf for obj in objs }
-    while objs:
-        (mconf,mobj) = (-1,None)
-        for (obj,conf) in cands.items():
-            if mconf < conf:
-                (mconf,mobj) = (conf,obj)
-        if mconf < threshold: break
-        result.append((mconf, mobj))
-        del cands[mobj]
-        cands = { obj: conf*exp(-3*(mobj.get_iou(obj.bbox)**2))
-                  for (obj,conf) in cands.items() }
-    result.sort(reverse=True)
-    return [ obj for (_,obj) in result ]
+    while alive.any():
+        i = np.argmax(np.where(alive, conf, -1))
+        if conf[i] < threshold: break
+        result.append(i)
+        alive[i] = False
+        # Decay the others by how much they cover the chosen one.
+        iw = np.minimum(x+w, x[i]+w[i]) - np.maximum(x, x[i])
+        ih = np.minimum(y+h, y[i]+h[i]) - np.maximum(y, y[i])
+        iou = np.where((0 < iw) & (0 < ih), iw*ih/(w[i]*h[i]), 0)
+        conf *= np.exp(-3*iou**2)
+    return objs[result]
 
 
 ##  Detector
@@ -69,19 +95,36 @@ class Detector:
         self.dbgout = dbgout
         return
 
-    def perform(self, data, threshold=0.1):
+    # perform: performs detection on an encoded image.
+    #   classes: set of class ids to detect (None: all classes).
+    #   roi: (x, y, w, h) in pixels. Only objects centered in it are detected.
+    #   state: dict kept by the caller between frames of the same stream.
+    def perform(self, data, threshold=0.1, classes=None, roi=None, state=None):
         if self.dbgout is not None:
             with open(self.dbgout, 'wb') as fp:
                 fp.write(data)
         return
 
+    # perform_array: performs detection on a decoded [H,W,3] uint8 image.
+    #   Returns a RESULT_DTYPE array (nothing is detected by default).
+    def perform_array(self, a, threshold=0.1, classes=None, roi=None, state=None):
+        return np.empty(0, dtype=RESULT_DTYPE)
+
+    # perform_batch: performs detection on a list of decoded images.
+    def perform_batch(self, arrays, threshold=0.1, classes=None, roi=None):
+        return [ self.perform_array(a, threshold=threshold, classes=classes, roi=roi)
+                 for a in arrays ]
+
 class DummyDetector(Detector):
 
     def __repr__(self):
         return (f'<DummyDetector>')
 
-    def perform(self, data, threshold=0.1):
+    def perform(self, data, threshold=0.1, classes=None, roi=None, state=None):
         super().perform(data)
+        return self.perform_array(None, threshold=threshold, classes=classes, roi=roi)
+
+    def perform_array(self, a, threshold=0.1, classes=None, roi=None, state=None):
         (width, height) = self.image_size
         klass = 16              # cat
         conf = 1.0
@@ -89,7 +132,13 @@ class DummyDetector(Detector):
         y = 0.5*height
         w = 0.4*width
         h = 0.4*height
-        return [(klass, conf, x, y, w, h)]
+        if classes is not None and klass not in classes:
+            return np.empty(0, dtype=RESULT_DTYPE)
+        if roi is not None:
+            (rx,ry,rw,rh) = roi
+            if not (rx <= x+w/2 < rx+rw and ry <= y+h/2 < ry+rh):
+                return np.empty(0, dtype=RESULT_DTYPE)
+        return np.array([(klass, conf, x, y, w, h)], dtype=RESULT_DTYPE)
 
 class ONNXDetector(Detector):
 
@@ -105,7 +154,10 @@ class ONNXDetector(Detector):
             ),
     }
 
-    def __init__(self, path, mode=None, num_classes=80, dbgout=None):
+    TILE_OVERLAP = 64           # pixels.
+    TILE_CHANGE = 8.0           # max. difference of 8x8 block means of a changed tile.
+
+    def __init__(self, path, mode=None, num_classes=80, dbgout=None, num_threads=None, tiled=False):
         super().__init__(num_classes=num_classes, dbgout=dbgout)
         import onnxruntime as ort
         providers = ['CPUExecutionProvider']
@@ -113,78 +165,474 @@ class ONNXDetector(Detector):
             providers.insert(0, 'CUDAExecutionProvider')
         elif mode == 'tensorrt':
             providers.insert(0, 'TensorrtExecutionProvider')
+        options = ort.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
         self.mode = mode
         self.path = path
-        self.model = ort.InferenceSession(path, providers=providers)
+        self.tiled = tiled
+        self.model = ort.InferenceSession(path, options, providers=providers)
+        # Fixed batch size of the model (None if dynamic).
+        batch_size = self.model.get_inputs()[0].shape[0]
+        self.batch_size = batch_size if isinstance(batch_size, int) else None
+        # IOBindings per thread and batch size.
+        self._local = threading.local()
         self.logger = logging.getLogger()
-        self.logger.info(f'load: path={path}, providers={providers}')
+        self.logger.info(f'load: path={path}, providers={providers}, batch_size={self.batch_size}')
         return
 
     def __repr__(self):
-        return (f'<ONNXDetector mode={self.mode}, path={self.path}, num_classes={self.num_classes}>')
+        return (f'<ONNXDetector mode={self.mode}, path={self.path}, num_classes={self.num_classes}, tiled={self.tiled}>')
 
-    def perform(self, data, threshold=0.1):
+    def perform(self, data, threshold=0.1, classes=None, roi=None, state=None):
         super().perform(data)
         from PIL import Image
-        (width, height) = self.image_size
         img = Image.open(io.BytesIO(data))
-        if img.size != self.image_size:
+        if img.size != self.image_size and not self.tiled:
             raise ValueError('invalid image size')
-        a = (np.array(img).reshape(1,height,width,3)/255).astype(np.float32)
-        a = a.transpose(0,3,1,2) # [N,H,W,C] -> [N,C,H,W]
-        outputs = self.model.run(None, {'input': a})
-        aas = self.ANCHORS[len(outputs)]
-        objs = []
-        for (anchors,output) in zip(aas, outputs):
-            output = output.transpose(0,2,3,1) # [N,C,H,W] -> [N,H,W,C]
-            objs.extend(self.process_yolo(anchors, output[0], threshold=threshold))
-        objs = soft_nms(objs, threshold=threshold)
-        results = [ (obj.klass, obj.conf,
-                     obj.bbox[0]*width, obj.bbox[1]*height,
-                     obj.bbox[2]*width, obj.bbox[3]*height) for obj in objs ]
-        self.logger.info(f'perform: results={results}')
-        return results
-
-    def process_yolo(self, anchors, m, threshold=0.1):
+        return self.perform_array(np.asarray(img.convert('RGB')), threshold=threshold,
+                                  classes=classes, roi=roi, state=state)
+
+    def perform_array(self, a, threshold=0.1, classes=None, roi=None, state=None):
+        if self.tiled:
+            return self.perform_tiled(a, threshold=threshold, classes=classes, roi=roi, state=state)
+        return self.perform_batch([a], threshold=threshold, classes=classes, roi=roi)[0]
+
+    # perform_tiled: performs detection on an image of any size
+    #   by splitting it into overlapping tiles. The tiles that have not
+    #   changed since the last frame in the same state are skipped.
+    def perform_tiled(self, a, threshold=0.1, classes=None, roi=None, state=None):
+        (width, height) = self.image_size
+        (h, w, _) = a.shape
+        if h < height or w < width:
+            b = np.zeros((max(h, height), max(w, width), 3), dtype=np.uint8)
+            b[:h,:w] = a
+            a = b
+        cache = {}
+        if state is not None:
+            key = (a.shape, threshold, None if classes is None else frozenset(classes))
+            if state.get('key') != key:
+                state['key'] = key
+                state['tiles'] = {}
+            cache = state['tiles']
+        tiles = []
+        todo = []
+        for ty in tile_positions(a.shape[0], height, self.TILE_OVERLAP):
+            for tx in tile_positions(a.shape[1], width, self.TILE_OVERLAP):
+                if roi is not None:
+                    (_,_,rw,rh) = rect_intersect(roi, (tx, ty, width, height))
+                    if rw <= 0 or rh <= 0: continue
+                tile = a[ty:ty+height, tx:tx+width]
+                thumb = block_means(tile)
+                if (tx, ty) in cache:
+                    (prev, results) = cache[(tx, ty)]
+                    # A change in any block counts, so that a small object is not missed.
+                    if np.abs(thumb - prev).max() < self.TILE_CHANGE:
+                        tiles.append(((tx, ty), results))
+                        continue
+                todo.append(((tx, ty), thumb, tile))
+        self.logger.debug(f'perform_tiled: tiles={len(tiles)+len(todo)}, skipped={len(tiles)}')
+        if todo:
+            batch = self.perform_batch([ tile for (_,_,tile) in todo ],
+                                       threshold=threshold, classes=classes)
+            for (((tx, ty), thumb, _), results) in zip(todo, batch):
+                cache[(tx, ty)] = (thumb, results)
+                tiles.append(((tx, ty), results))
+        # Move to the frame coordinates and merge the duplicates at seams.
+        objs = [ np.empty(0, dtype=RESULT_DTYPE) ]
+        for ((tx, ty), results) in tiles:
+            results = results.copy()
+            results['x'] += tx
+            results['y'] += ty
+            objs.append(results)
+        objs = np.concatenate(objs)
+        if roi is not None:
+            (rx,ry,rw,rh) = roi
+            cx = objs['x'] + objs['w']/2
+            cy = objs['y'] + objs['h']/2
+            objs = objs[(rx <= cx) & (cx < rx+rw) & (ry <= cy) & (cy < ry+rh)]
+        return soft_nms(objs, threshold=threshold)
+
+    def perform_batch(self, arrays, threshold=0.1, classes=None, roi=None):
+        (width, height) = self.image_size
+        for a in arrays:
+            if a.shape != (height,width,3):
+                raise ValueError('invalid image size')
+        if roi is not None:
+            # Normalize to [0,1].
+            (x,y,w,h) = roi
+            roi = (x/width, y/height, w/width, h/height)
+        if classes is not None:
+            # Mask of allowed class channels.
+            allowed = np.zeros(self.num_classes, dtype=bool)
+            allowed[[ c-1 for c in classes if 0 < c <= self.num_classes ]] = True
+            classes = allowed
+        n = self.batch_size or len(arrays)
+        batch = []
+        for i0 in range(0, len(arrays), n):
+            outputs = self.run(arrays[i0:i0+n])
+            aas = self.ANCHORS[len(outputs)]
+            for i in range(len(arrays[i0:i0+n])):
+                objs = np.concatenate([
+                    # [C,H,W] -> [H,W,C]
+                    self.process_yolo(anchors, output[i].transpose(1,2,0), threshold=threshold,
+                                      classes=classes, roi=roi)
+                    for (anchors,output) in zip(aas, outputs) ])
+                results = soft_nms(objs, threshold=threshold)
+                results['x'] *= width
+                results['y'] *= height
+                results['w'] *= width
+                results['h'] *= height
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug(f'perform: results={results.tolist()}')
+                batch.append(results)
+        return batch
+
+    # run: performs inference with preallocated input/output buffers.
+    #   The outputs are overwritten by the next call.
+    def run(self, arrays):
+        n = self.batch_size or len(arrays)
+        (binding, a, outputs) = self.get_binding(n)
+        for (i, src) in enumerate(arrays):
+            # [H,W,C] uint8 -> [C,H,W] float32, written into the bound input.
+            np.divide(src.transpose(2,0,1), np.float32(255), out=a[i], dtype=np.float32)
+        a[len(arrays):] = 0
+        self.model.run_with_iobinding(binding)
+        return outputs
+
+    def get_binding(self, n):
+        bindings = getattr(self._local, 'bindings', None)
+        if bindings is None:
+            bindings = self._local.bindings = {}
+        if n not in bindings:
+            (width, height) = self.image_size
+            a = np.zeros((n,3,height,width), dtype=np.float32)
+            # Run once to get the output shapes.
+            outputs = [ np.empty_like(output) for output in self.model.run(None, {'input': a}) ]
+            binding = self.model.io_binding()
+            binding.bind_input('input', 'cpu', 0, np.float32, a.shape, a.ctypes.data)
+            for (meta, output) in zip(self.model.get_outputs(), outputs):
+                binding.bind_output(meta.name, 'cpu', 0, np.float32, output.shape, output.ctypes.data)
+            self.logger.info(f'get_binding: batch_size={n}')
+            bindings[n] = (binding, a, outputs)
+        return bindings[n]
+
+    # process_yolo: decodes one output layer into normalized results.
+    #   classes: mask of allowed class channels (None: all classes).
+    #     The class is chosen among all channels and then filtered,
+    #     so that an object is never relabeled as an allowed class.
+    #   roi: normalized (x, y, w, h). Grid cells outside it are skipped.
+    def process_yolo(self, anchors, m, threshold=0.1, classes=None, roi=None):
         (width, height) = self.image_size
         (rows,cols,_) = m.shape
-        a = []
-        for (y0,row) in enumerate(m):
-            for (x0,col) in enumerate(row):
-                for (k,(ax,ay)) in enumerate(anchors):
-                    b = (5+self.num_classes) * k
-                    conf = sigmoid(col[b+4])
-                    if conf < threshold: continue
-                    x = (x0 + sigmoid(col[b+0])) / cols
-                    y = (y0 + sigmoid(col[b+1])) / rows
-                    w = ax * exp(col[b+2]) / width
-                    h = ay * exp(col[b+3]) / height
-                    mi = np.argmax(col[b+5:b+5+self.num_classes])
-                    conf *= sigmoid(col[b+5+mi])
-                    if conf < threshold: continue
-                    a.append(YOLOObject(mi+1, conf, (x-w/2, y-h/2, w, h)))
-        return a
+        if classes is not None and not classes.any():
+            return np.empty(0, dtype=RESULT_DTYPE)
+        (rx0,ry0,rx1,ry1) = (0,0,1,1)
+        (xs,ys) = (0,0)
+        if roi is not None:
+            (rx0,ry0) = (roi[0], roi[1])
+            (rx1,ry1) = (roi[0]+roi[2], roi[1]+roi[3])
+            xs = min(max(0, int(rx0*cols)), cols)
+            ys = min(max(0, int(ry0*rows)), rows)
+            m = m[ys:max(ys, int(ry1*rows)+1), xs:max(xs, int(rx1*cols)+1)]
+        # sigmoid(x) < threshold <=> x < logit(threshold)
+        if threshold <= 0:
+            logit = -np.inf
+        elif 1 <= threshold:
+            logit = np.inf
+        else:
+            logit = np.log(threshold/(1-threshold))
+        stride = 5+self.num_classes
+        results = [ np.empty(0, dtype=RESULT_DTYPE) ]
+        for (k,(ax,ay)) in enumerate(anchors):
+            mk = m[:,:,stride*k:stride*(k+1)]
+            (y0, x0) = np.nonzero(logit <= mk[:,:,4])
+            if len(y0) == 0: continue
+            v = mk[y0, x0]      # [N,5+num_classes]
+            mi = np.argmax(v[:,5:], axis=1)
+            if classes is not None:
+                keep = classes[mi]
+                (y0, x0, v, mi) = (y0[keep], x0[keep], v[keep], mi[keep])
+                if len(mi) == 0: continue
+            conf = (sigmoid(v[:,4].astype(np.float64)) *
+                    sigmoid(v[np.arange(len(mi)), 5+mi].astype(np.float64)))
+            x = (x0 + xs + sigmoid(v[:,0].astype(np.float64))) / cols
+            y = (y0 + ys + sigmoid(v[:,1].astype(np.float64))) / rows
+            w = ax * np.exp(v[:,2].astype(np.float64)) / width
+            h = ay * np.exp(v[:,3].astype(np.float64)) / height
+            ok = (threshold <= conf) & (rx0 <= x) & (x < rx1) & (ry0 <= y) & (y < ry1)
+            objs = np.empty(np.count_nonzero(ok), dtype=RESULT_DTYPE)
+            objs['klass'] = mi[ok]+1
+            objs['conf'] = conf[ok]
+            objs['x'] = (x-w/2)[ok]
+            objs['y'] = (y-h/2)[ok]
+            objs['w'] = w[ok]
+            objs['h'] = h[ok]
+            results.append(objs)
+        return np.concatenate(results)
+
+##  Bulk mode
+##
+BULK_EXTS = ('.jpg', '.jpeg', '.png')
+BULK_TARS = ('.tar', '.tar.gz', '.tgz')
+
+# bulk_inputs: yields (name, data) from files, directories, globs,
+#   tar archives or a file list from stdin ("-"). Names in done are skipped.
+#   data is the exception if the input cannot be read.
+def bulk_inputs(args, done):
+    import os
+    import glob
+    import tarfile
+    for arg in args:
+        if arg == '-':
+            for line in sys.stdin:
+                line = line.strip()
+                if line:
+                    yield from bulk_inputs([line], done)
+        elif os.path.isdir(arg):
+            for (dirpath, dirnames, filenames) in os.walk(arg):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    if name.lower().endswith(BULK_EXTS):
+                        yield from bulk_inputs([os.path.join(dirpath, name)], done)
+        elif arg.lower().endswith(BULK_TARS):
+            try:
+                with tarfile.open(arg) as tar:
+                    for member in tar:
+                        name = f'{arg}:{member.name}'
+                        if not member.isfile() or name in done: continue
+                        if not member.name.lower().endswith(BULK_EXTS): continue
+                        yield (name, tar.extractfile(member).read())
+            except OSError as e:
+                yield (arg, e)
+            except (EOFError, tarfile.TarError) as e:
+                yield (arg, ValueError(f'invalid archive: {e}'))
+        elif any( c in arg for c in '*?[' ):
+            yield from bulk_inputs(sorted(glob.glob(arg, recursive=True)), done)
+        elif arg not in done:
+            try:
+                with open(arg, 'rb') as fp:
+                    data = fp.read()
+            except OSError as e:
+                data = e
+            yield (arg, data)
+    return
+
+# bulk_batches: groups the inputs. The number of batches in flight
+#   is limited by sem so that inputs are not read too far ahead.
+def bulk_batches(items, batch_size, sem=None):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if batch_size <= len(batch):
+            if sem is not None: sem.acquire()
+            yield batch
+            batch = []
+    if batch:
+        if sem is not None: sem.acquire()
+        yield batch
+    return
+
+# bulk_resume: returns the names already done (with results) in the output.
+#   An incomplete last line is truncated. Malformed lines are ignored.
+def bulk_resume(output):
+    import os
+    import json
+    done = set()
+    if not os.path.exists(output): return done
+    with open(output, 'r+b') as fp:
+        size = 0
+        for line in fp:
+            if not line.endswith(b'\n'): break
+            size += len(line)
+            try:
+                rec = json.loads(line)
+                # Failed inputs are tried again.
+                if 'results' in rec:
+                    done.add(rec['name'])
+            except (ValueError, KeyError, TypeError):
+                pass
+        fp.truncate(size)
+    return done
+
+def bulk_decode(data, image_size):
+    from PIL import Image, UnidentifiedImageError
+    if isinstance(data, Exception):
+        raise data
+    try:
+        img = Image.open(io.BytesIO(data)).convert('RGB')
+    except UnidentifiedImageError:
+        # The original message contains the address of the buffer.
+        raise ValueError('cannot identify image')
+    if img.size != image_size:
+        raise ValueError('invalid image size')
+    return np.asarray(img)
+
+# Per-process state: (detector, threshold, thread pool)
+_bulk = None
+
+def bulk_init(path, mode, num_classes, threshold, num_threads, ort_threads):
+    global _bulk
+    from concurrent.futures import ThreadPoolExecutor
+    detector = ONNXDetector(path, mode=mode, num_classes=num_classes, num_threads=ort_threads)
+    _bulk = (detector, threshold, ThreadPoolExecutor(num_threads))
+    return
+
+def bulk_submit(batch):
+    (detector, _, pool) = _bulk
+    return [ (name, pool.submit(bulk_decode, data, detector.image_size))
+             for (name, data) in batch ]
+
+# bulk_infer: returns (records, inference time).
+def bulk_infer(decoded):
+    (detector, threshold, _) = _bulk
+    records = []
+    names = []
+    arrays = []
+    for (name, future) in decoded:
+        try:
+            arrays.append(future.result())
+            names.append(name)
+        except (OSError, ValueError) as e:
+            records.append({'name': name, 'error': str(e)})
+    t0 = time.time()
+    batch = detector.perform_batch(arrays, threshold=threshold) if arrays else []
+    dt = time.time() - t0
+    for (name, results) in zip(names, batch):
+        results = [ (klass, round(conf, 4),
+                     round(x, 1), round(y, 1), round(w, 1), round(h, 1))
+                    for (klass, conf, x, y, w, h) in results.tolist() ]
+        records.append({'name': name, 'results': results})
+    return (records, dt)
+
+# bulk_batch: decodes and performs a batch (for a worker process).
+def bulk_batch(batch):
+    return bulk_infer(bulk_submit(batch))
+
+# bulk_prefetch: decodes the next batches while performing the current one.
+def bulk_prefetch(batches, depth=2):
+    pending = deque()
+    for batch in batches:
+        pending.append(bulk_submit(batch))
+        if depth < len(pending):
+            yield bulk_infer(pending.popleft())
+    while pending:
+        yield bulk_infer(pending.popleft())
+    return
+
+def bulk(args, output, path, mode=None, num_classes=80, threshold=0.1,
+         batch_size=8, num_threads=4, num_procs=1):
+    import os
+    import json
+    import threading
+    from multiprocessing import Pool
+    done = bulk_resume(output)
+    items = bulk_inputs(args, done)
+    ort_threads = None
+    if 1 < num_procs:
+        ort_threads = max(1, (os.cpu_count() or 1) // num_procs)
+    initargs = (path, mode, num_classes, threshold, num_threads, ort_threads)
+    sem = threading.BoundedSemaphore(2*num_procs)
+    pool = None
+    if num_procs == 1:
+        bulk_init(*initargs)
+        it = bulk_prefetch(bulk_batches(items, batch_size))
+    else:
+        pool = Pool(num_procs, bulk_init, initargs)
+        it = pool.imap(bulk_batch, bulk_batches(items, batch_size, sem))
+    (nimages, nerrors) = (0, 0)
+    # Batch inference time divided among its images (excludes decoding).
+    per_image = []
+    t0 = time.time()
+    try:
+        with open(output, 'a') as fp:
+            for (records, dt) in it:
+                if pool is not None: sem.release()
+                for rec in records:
+                    fp.write(json.dumps(rec)+'\n')
+                    if 'error' in rec: nerrors += 1
+                fp.flush()
+                n = sum( 1 for rec in records if 'results' in rec )
+                nimages += n
+                if n:
+                    per_image.extend( [dt/n]*n )
+    finally:
+        if pool is not None:
+            pool.terminate()
+    elapsed = time.time() - t0
+    per_image.sort()
+    print(f'images={nimages}, errors={nerrors}, skipped={len(done)}, elapsed={elapsed:.1f}s, '
+          f'throughput={nimages/elapsed if elapsed else 0:.1f}/s')
+    if per_image:
+        mean = sum(per_image)/len(per_image)
+        p50 = per_image[len(per_image)//2]
+        p95 = per_image[int(len(per_image)*0.95)]
+        print(f'inference per image: mean={mean*1000:.1f}ms, p50={p50*1000:.1f}ms, p95={p95*1000:.1f}ms')
+    return
+
+# bench_alloc: measures memory allocated while performing a frame.
+def bench_alloc(detector, arrays, threshold=0.1, repeat=100):
+    import gc
+    import tracemalloc
+    detector.perform_batch(arrays, threshold=threshold) # warm up
+    tracemalloc.start()
+    ngc = sum( stat['collections'] for stat in gc.get_stats() )
+    peak = 0
+    t0 = time.time()
+    for _ in range(repeat):
+        (current, _) = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        detector.perform_batch(arrays, threshold=threshold)
+        peak += tracemalloc.get_traced_memory()[1] - current
+    dt = time.time() - t0
+    ngc = sum( stat['collections'] for stat in gc.get_stats() ) - ngc
+    tracemalloc.stop()
+    n = repeat*len(arrays)
+    print(f'frames={n}, batch={len(arrays)}, time={dt/n*1000:.2f}ms, '
+          f'peak={peak/n/1024:.1f}KiB, gc={ngc/n:.3f} per frame')
+    return
 
 # main
 def main(argv):
     import getopt
     def usage():
         print(f'usage: {argv[0]} [-m mode] [-c num_classes] [-t threshold] onnx images ...')
+        print(f'       {argv[0]} [-m mode] [-c num_classes] [-t threshold] -a repeat onnx images ...')
+        print(f'       {argv[0]} [-m mode] [-c num_classes] [-t threshold] -o output.jsonl [-b batch] [-j threads] [-p procs] onnx {{dir|glob|tar|-}} ...')
         return 100
     try:
-        (opts, args) = getopt.getopt(argv[1:], 'm:c:t:')
+        (opts, args) = getopt.getopt(argv[1:], 'm:c:t:o:b:j:p:a:')
     except getopt.GetoptError:
         return usage()
     mode = None
     num_classes = 80
     threshold = 0.1
+    output = None
+    batch_size = 8
+    num_threads = 4
+    num_procs = 1
+    repeat = 0
     for (k, v) in opts:
         if k == '-m': mode = v
         elif k == '-c': num_classes = int(v)
         elif k == '-t': threshold = float(v)
+        elif k == '-o': output = v
+        elif k == '-b': batch_size = int(v)
+        elif k == '-j': num_threads = int(v)
+        elif k == '-p': num_procs = int(v)
+        elif k == '-a': repeat = int(v)
     if not args: return usage()
     path = args.pop(0)
+    if output is not None:
+        bulk(args, output, path, mode=mode, num_classes=num_classes, threshold=threshold,
+             batch_size=batch_size, num_threads=num_threads, num_procs=num_procs)
+        return
     detector = ONNXDetector(path, mode=mode, num_classes=num_classes)
+    if repeat:
+        from PIL import Image
+        arrays = [ np.asarray(Image.open(path).convert('RGB')) for path in args ]
+        bench_alloc(detector, arrays, threshold=threshold, repeat=repeat)
+        return
     for path in args:
         with open(path, 'rb') as fp:
             data = fp.read()
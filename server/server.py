@@ -8,12 +8,17 @@
 ##    (full w/cuda) $ python server.py -m cuda yolov3-full.onnx
 ##
 import sys
+import os
+import os.path
 import logging
 import time
 import selectors
 import socket
 import struct
 import random
+import tempfile
+from collections import deque
+import numpy as np
 from detector import DummyDetector, ONNXDetector
 
 
@@ -56,37 +61,100 @@ class SocketHandler:
 ##
 class TCPService(SocketHandler):
 
+    MAX_FRAME = 16*1024*1024
+    MAX_OUTPUT = 1024*1024
+
     def __init__(self, sock):
         super().__init__(sock)
-        self.buf = b''
+        # Never block the event loop on a client that does not read.
+        self.sock.setblocking(False)
+        self.buf = bytearray()
+        self.obuf = bytearray()
+        self.framed = False
         return
 
     def action(self, ev):
+        if ev & selectors.EVENT_WRITE:
+            self.flush()
+        if not (ev & selectors.EVENT_READ): return
         try:
             data = self.sock.recv(self.BUFSIZ)
         except OSError:
             self.shutdown()
             return
         if data:
-            i0 = 0
-            while i0 < len(data):
-                i1 = data.find(b'\n', i0)
-                if i1 < 0:
-                    self.buf += data[i0:]
-                    break
-                self.buf += data[i0:i1+1]
-                self.feedline(self.buf)
-                self.buf = b''
-                i0 = i1+1
+            self.buf += data
+            self.parse()
         else:
-            if self.buf:
-                self.feedline(self.buf)
+            if self.buf and not self.framed:
+                self.feedline(bytes(self.buf))
             self.shutdown()
         return
 
+    # parse: splits the buffer into lines, or into
+    #   length-prefixed frames once self.framed is set.
+    def parse(self):
+        i0 = 0
+        while self.alive and i0 < len(self.buf):
+            if self.framed:
+                if len(self.buf) < i0+4: break
+                (length,) = struct.unpack('>L', self.buf[i0:i0+4])
+                if self.MAX_FRAME < length:
+                    self.logger.error(f'parse: frame too large: length={length}')
+                    self.shutdown()
+                    break
+                i1 = i0+4+length
+                if len(self.buf) < i1: break
+                self.feedframe(bytes(self.buf[i0+4:i1]))
+            else:
+                i1 = self.buf.find(b'\n', i0)
+                if i1 < 0: break
+                i1 += 1
+                self.feedline(bytes(self.buf[i0:i1]))
+            i0 = i1
+        del self.buf[:i0]
+        return
+
     def feedline(self, line):
         return
 
+    def feedframe(self, data):
+        return
+
+    def sendframe(self, data):
+        self.send(struct.pack('>L', len(data))+data)
+        return
+
+    # send: queues data and writes as much as the socket takes now.
+    #   The rest is written when the socket becomes writable.
+    def send(self, data):
+        if not self.alive: return
+        if self.MAX_OUTPUT < len(self.obuf)+len(data):
+            # The client is not reading. Giving up.
+            self.logger.error(f'send: output buffer full: {self}, size={len(self.obuf)}')
+            self.shutdown()
+            return
+        self.obuf += data
+        self.flush()
+        return
+
+    def flush(self):
+        try:
+            if self.obuf:
+                n = self.sock.send(self.obuf)
+                del self.obuf[:n]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.shutdown()
+            return
+        if self.loop is not None:
+            events = selectors.EVENT_READ
+            if self.obuf:
+                events |= selectors.EVENT_WRITE
+            self.loop.modify(self, events)
+        return
+
 
 ##  UDPService
 ##
@@ -100,7 +168,8 @@ class UDPService(SocketHandler):
         try:
             (data, addr) = self.sock.recvfrom(self.BUFSIZ)
             self.recvdata(data, addr)
-        except OSError:
+        except (OSError, ValueError) as e:
+            self.logger.error(f'action: {self}: {e!r}')
             self.shutdown()
         return
 
@@ -135,14 +204,190 @@ class TCPServer(SocketHandler):
         return TCPService(self, conn)
 
 
+##  SchedQueue
+##
+class SchedQueue:
+
+    def __init__(self, session, path, priority=0, fps=None, maxlen=2):
+        self.session = session
+        self.path = path
+        self.priority = priority
+        self.fps = fps
+        self.jobs = deque(maxlen=maxlen)
+        self.created = time.time()
+        self.last = 0
+        self.served = 0
+        self.dropped = 0
+        self.wait_total = 0
+        self.wait_max = 0
+        return
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}: path={self.path}, priority={self.priority}, fps={self.fps}, session={self.session}>'
+
+    # rate: the declared frame rate, or the measured one if not declared.
+    #   Only served frames count; dropped ones do not use the detector.
+    def rate(self, default):
+        if self.fps is not None: return self.fps
+        dt = time.time() - self.created
+        if dt < 1: return default
+        return self.served/dt
+
+    def record(self, wait):
+        self.served += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        return
+
+    def stats(self):
+        avg = self.wait_total/self.served if self.served else 0
+        return (f'served={self.served}, dropped={self.dropped}, '
+                f'wait_avg={avg*1000:.1f}ms, wait_max={self.wait_max*1000:.1f}ms')
+
+
+##  Scheduler
+##
+##  Deficit round robin across detector paths (weighted by cost of
+##  inference time), round robin across sessions within a path.
+##  Higher priority classes are always served first.
+##  New sessions are admitted only if the total inference time
+##  (measured time per frame x frame rate) stays within capacity.
+##
+class Scheduler:
+
+    QUANTUM = 0.05              # inference seconds per round.
+    QUEUE_SIZE = 2              # frames queued per session.
+    STATS_INTERVAL = 10
+    UTILIZATION = 0.9           # max. fraction of time spent for inference.
+    DEFAULT_FPS = 10            # assumed frame rate if not declared.
+    RETRY_AFTER = 5
+
+    def __init__(self, weights=None, limits=None, max_priority=0):
+        self.logger = logging.getLogger()
+        self.weights = weights or {}
+        self.limits = limits or {}
+        self.max_priority = max_priority
+        self.queues = {}
+        self.deficits = {}
+        self.costs = {}
+        self._paths = []
+        self._tick = 0
+        self._stats_time = time.time()
+        return
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}: weights={self.weights}, limits={self.limits}, max_priority={self.max_priority}>'
+
+    def load(self):
+        return sum( q.rate(self.DEFAULT_FPS) * self.costs.get(q.path, 0)
+                    for q in self.queues.values() )
+
+    # admit: returns None if a new session can be accepted,
+    #   or the number of seconds to wait otherwise.
+    #   The first session of a path is always accepted.
+    def admit(self, path, fps=None):
+        nsessions = sum( 1 for q in self.queues.values() if q.path == path )
+        if path in self.limits and self.limits[path] <= nsessions:
+            self.logger.info(f'sched: admit: too many sessions: path={path}, nsessions={nsessions}')
+            return self.RETRY_AFTER
+        if nsessions == 0: return None
+        # Use the slowest detector as a guess until it is measured.
+        cost = self.costs.get(path, max(self.costs.values(), default=0))
+        if fps is not None:
+            load = self.load() + fps * cost
+        else:
+            # An undeclared session gets at most an equal share.
+            load = self.load() + min(self.DEFAULT_FPS * cost,
+                                     self.UTILIZATION / (len(self.queues)+1))
+        if self.UTILIZATION < load:
+            self.logger.info(f'sched: admit: overloaded: path={path}, fps={fps}, load={load:.2f}')
+            return self.RETRY_AFTER
+        return None
+
+    def add(self, session, path, priority=0, fps=None):
+        q = SchedQueue(session, path, priority=priority, fps=fps, maxlen=self.QUEUE_SIZE)
+        self.queues[session] = q
+        if path not in self.deficits:
+            self.deficits[path] = 0
+            self._paths.append(path)
+        self.logger.info(f'sched: add: {q}')
+        return
+
+    def remove(self, session):
+        q = self.queues.pop(session, None)
+        if q is None: return
+        self.logger.info(f'sched: remove: {q}, {q.stats()}')
+        return
+
+    def submit(self, session, data):
+        q = self.queues[session]
+        if len(q.jobs) == q.jobs.maxlen:
+            # Queue is full. Discarding the oldest frame.
+            q.dropped += 1
+        q.jobs.append((time.time(), data))
+        return
+
+    def pending(self):
+        return any( q.jobs for q in self.queues.values() )
+
+    def run(self):
+        q = self.select()
+        if q is not None:
+            (t0, data) = q.jobs.popleft()
+            t1 = time.time()
+            try:
+                q.session.process_data(data)
+            except (OSError, ValueError) as e:
+                # Broken frame (e.g. undecodable image). Dropping the session.
+                self.logger.error(f'sched: run: {q}: {e!r}')
+                q.session.shutdown()
+                q.jobs.clear()
+            cost = time.time() - t1
+            q.record(t1 - t0)
+            self.deficits[q.path] -= cost
+            # Exponential moving average of inference time.
+            # The first frame of a session (model warm-up) is not counted.
+            if 1 < q.served:
+                self.costs[q.path] = 0.9*self.costs.get(q.path, cost) + 0.1*cost
+            self.logger.debug(
+                f'sched: run: path={q.path}, wait={(t1-t0)*1000:.1f}ms, cost={cost*1000:.1f}ms')
+        if self.STATS_INTERVAL < time.time() - self._stats_time:
+            self._stats_time = time.time()
+            for q in self.queues.values():
+                self.logger.info(f'sched: stats: {q}, {q.stats()}')
+        return
+
+    def select(self):
+        queues = [ q for q in self.queues.values() if q.jobs ]
+        if not queues: return None
+        priority = max( q.priority for q in queues )
+        queues = [ q for q in queues if q.priority == priority ]
+        paths = set( q.path for q in queues )
+        busy = set( q.path for q in self.queues.values() if q.jobs )
+        while True:
+            path = self._paths[0]
+            if path in paths and 0 < self.deficits[path]: break
+            # Turn is over. Move the path to the tail and refill.
+            self._paths.append(self._paths.pop(0))
+            if path in paths:
+                self.deficits[path] += self.QUANTUM * self.weights.get(path, 1)
+            elif path not in busy:
+                self.deficits[path] = 0
+        q = min(( q for q in queues if q.path == path ), key=lambda q: q.last)
+        self._tick += 1
+        q.last = self._tick
+        return q
+
+
 ##  EventLoop
 ##
 class EventLoop:
 
-    def __init__(self):
+    def __init__(self, scheduler=None):
         self.logger = logging.getLogger()
         self.selector = selectors.DefaultSelector()
         self.handlers = {}
+        self.scheduler = scheduler
         return
 
     def add(self, handler):
@@ -153,12 +398,26 @@ class EventLoop:
         handler.loop = self
         return
 
+    def modify(self, handler, events):
+        fd = self.selector.get_key(handler.sock)
+        if fd.events == events: return
+        del self.handlers[fd]
+        fd = self.selector.modify(handler.sock, events)
+        self.handlers[fd] = handler
+        return
+
     def run(self, interval=0.1):
         while True:
-            for (fd, ev) in self.selector.select(interval):
-                if ev & selectors.EVENT_READ and fd in self.handlers:
+            # Do not block while there are frames waiting for inference.
+            timeout = interval
+            if self.scheduler is not None and self.scheduler.pending():
+                timeout = 0
+            for (fd, ev) in self.selector.select(timeout):
+                if fd in self.handlers:
                     handler = self.handlers[fd]
                     handler.action(ev)
+            if self.scheduler is not None:
+                self.scheduler.run()
             self.idle()
         return
 
@@ -175,19 +434,70 @@ class EventLoop:
         return
 
 
+# process_request: performs detection for a request and returns a response.
+def process_request(detector, data, state=None):
+    if len(data) < 16: return None # invalid data
+    (tp, reqid, threshold, length) = struct.unpack('>4sLLL', data[:16])
+    data = data[16:]
+    (classes, roi) = (None, None)
+    if tp == b'JPGX':
+        try:
+            (classes, roi, data) = unpack_filter(data)
+        except ValueError:
+            return None
+    if len(data) != length: return None # missing data
+    t0 = time.time()
+    results = detector.perform(data, threshold=threshold*0.01, classes=classes, roi=roi, state=state)
+    msec = int((time.time() - t0)*1000)
+    return pack_results(reqid, msec, results)
+
+# unpack_filter: parses a request extension and returns (classes, roi, rest).
+#   roi: x, y, w, h (int16), nclasses (uint16), classes (uint8 * nclasses)
+def unpack_filter(data):
+    if len(data) < 10: raise ValueError('invalid filter')
+    (x, y, w, h, n) = struct.unpack('>hhhhH', data[:10])
+    if len(data) < 10+n: raise ValueError('invalid filter')
+    classes = set(data[10:10+n]) if n else None
+    roi = (x, y, w, h) if (0 < w and 0 < h) else None
+    return (classes, roi, data[10+n:])
+
+# Detection result on the wire: '>BBhhhh'
+WIRE_DTYPE = np.dtype([
+    ('klass', 'u1'), ('conf', 'u1'),
+    ('x', '>i2'), ('y', '>i2'), ('w', '>i2'), ('h', '>i2'),
+])
+
+# pack_results: builds a response.
+def pack_results(reqid, msec, results):
+    buf = np.empty(len(results), dtype=WIRE_DTYPE)
+    buf['klass'] = results['klass']
+    buf['conf'] = results['conf']*255
+    for k in ('x', 'y', 'w', 'h'):
+        buf[k] = np.clip(results[k], -32768, 32767)
+    buf = buf.tobytes()
+    header = struct.pack('>4sLLL', b'YOLO', reqid, msec, len(buf))
+    return header+buf
+
+
 ##  DetectService
 ##
 class DetectService(UDPService):
 
     CHUNK_SIZE = 40000
 
-    def __init__(self, sock, detector, rtp_host, rtp_port, session_id, timeout=10):
+    def __init__(self, sock, detector, rtp_host, rtp_port, session_id,
+                 path=None, priority=0, fps=None, scheduler=None, timeout=10):
         super().__init__(sock)
         self.detector = detector
         self.rtp_host = rtp_host
         self.rtp_port = rtp_port
         self.session_id = session_id
+        self.path = path
+        self.priority = priority
+        self.fps = fps
+        self.scheduler = scheduler
         self.timeout = timeout
+        self.state = {}
         self._recv_buf = b''
         self._recv_seqno = 0
         self._send_seqno = 0
@@ -201,6 +511,14 @@ class DetectService(UDPService):
         data = b'\x80\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
         self.sock.sendto(data, (self.rtp_host, self.rtp_port))
         self._send_seqno += 1
+        if self.scheduler is not None:
+            self.scheduler.add(self, self.path, priority=self.priority, fps=self.fps)
+        return
+
+    def close(self):
+        if self.scheduler is not None:
+            self.scheduler.remove(self)
+        super().close()
         return
 
     def recvdata(self, data, addr):
@@ -217,27 +535,19 @@ class DetectService(UDPService):
         if pt & 0x80:
             # Significant packet - ending the payload.
             if self._recv_buf is not None:
-                self.process_data(self._recv_buf)
+                if self.scheduler is not None:
+                    self.scheduler.submit(self, self._recv_buf)
+                else:
+                    self.process_data(self._recv_buf)
             self._recv_buf = b''
         self._recv_seqno = seqno+1
         return
 
     def process_data(self, data):
         self.logger.debug(f'process_data: {len(data)}')
-        if len(data) < 16: return # invalid data
-        (tp, reqid, threshold, length) = struct.unpack('>4sLLL', data[:16])
-        data = data[16:]
-        if len(data) != length: return # missing data
-        t0 = time.time()
-        results = self.detector.perform(data, threshold=threshold*0.01)
-        msec = int((time.time() - t0)*1000)
-        buf = b''
-        for (klass, conf, x, y, w, h) in results:
-            buf += struct.pack(
-                '>BBhhhh', klass, int(conf*255),
-                int(x), int(y), int(w), int(h))
-        header = struct.pack('>4sLLL', b'YOLO', reqid, msec, len(buf))
-        self.send(header+buf)
+        resp = process_request(self.detector, data, self.state)
+        if resp is not None:
+            self.send(resp)
         return
 
     def send(self, data, chunk_size=CHUNK_SIZE):
@@ -254,14 +564,118 @@ class DetectService(UDPService):
             i0 = i1
         return
 
+##  ShmService
+##
+##  Frames are placed in a shared memory ring by a co-located client.
+##  Each slot is a 64-byte header (uint32 reqid) followed by
+##  a [H,W,3] uint8 image. Notifications and responses go over
+##  a Unix datagram socket.
+##
+class ShmService(UDPService):
+
+    SLOT_HEADER = 64
+
+    def __init__(self, sock, detector, session_id, nslots=4,
+                 path=None, priority=0, fps=None, scheduler=None):
+        from multiprocessing import shared_memory
+        super().__init__(sock)
+        self.detector = detector
+        self.session_id = session_id
+        self.nslots = nslots
+        self.path = path
+        self.priority = priority
+        self.fps = fps
+        self.scheduler = scheduler
+        self.state = {}
+        (width, height) = detector.image_size
+        self.slot_size = self.SLOT_HEADER + height*width*3
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slot_size*nslots)
+        self.reqids = [ np.ndarray((1,), dtype='<u4', buffer=self.shm.buf,
+                                   offset=i*self.slot_size)
+                        for i in range(nslots) ]
+        self.frames = [ np.ndarray((height,width,3), dtype=np.uint8, buffer=self.shm.buf,
+                                   offset=i*self.slot_size+self.SLOT_HEADER)
+                        for i in range(nslots) ]
+        self.peer = None
+        return
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}: shm={self.shm.name}, nslots={self.nslots}, session_id={self.session_id}>'
+
+    def init(self):
+        self.logger.info(f'init: shm={self.shm.name}, nslots={self.nslots}, addr={self.addr}, session_id={self.session_id}')
+        if self.scheduler is not None:
+            self.scheduler.add(self, self.path, priority=self.priority, fps=self.fps)
+        return
+
+    def close(self):
+        if self.scheduler is not None:
+            self.scheduler.remove(self)
+        addr = self.addr
+        super().close()
+        os.unlink(addr)
+        # Views must be released before closing the buffer.
+        self.reqids = self.frames = None
+        self.shm.close()
+        self.shm.unlink()
+        return
+
+    def recvdata(self, data, addr):
+        if self.peer is None:
+            # The first datagram tells the client address.
+            self.peer = addr
+            self.logger.info(f'recv: peer={addr}')
+        if addr != self.peer: return
+        if len(data) < 16: return
+        if self.scheduler is not None:
+            self.scheduler.submit(self, data)
+        else:
+            self.process_data(data)
+        return
+
+    # process_data: "SHMF" reqid threshold slot
+    #               "SHMX" reqid threshold slot filter
+    def process_data(self, data):
+        (tp, reqid, threshold, slot) = struct.unpack('>4sLLL', data[:16])
+        (classes, roi) = (None, None)
+        if tp == b'SHMX':
+            try:
+                (classes, roi, _) = unpack_filter(data[16:])
+            except ValueError:
+                return
+        elif tp != b'SHMF':
+            return
+        if self.nslots <= slot: return
+        if self.reqids[slot][0] != reqid: return # already overwritten
+        t0 = time.time()
+        results = self.detector.perform_array(
+            self.frames[slot], threshold=threshold*0.01, classes=classes, roi=roi,
+            state=self.state)
+        msec = int((time.time() - t0)*1000)
+        if self.reqids[slot][0] != reqid:
+            # The slot was overwritten while being read.
+            self.logger.info(f'process_data: STALE {reqid}')
+            return
+        try:
+            self.sock.sendto(pack_results(reqid, msec, results), self.peer)
+        except OSError:
+            self.shutdown()
+        return
+
 ##  RTSPService
 ##
 class RTSPService(TCPService):
 
-    def __init__(self, sock, detectors):
+    def __init__(self, sock, detectors, scheduler=None):
         super().__init__(sock)
         self.detectors = detectors
+        self.scheduler = scheduler
         self.service = None
+        # TCP transport.
+        self.detector = None
+        self.path = None
+        self.priority = 0
+        self.state = {}
         return
 
     def feedline(self, req):
@@ -270,7 +684,7 @@ class RTSPService(TCPService):
         if cmd == b'FEED':
             self.startfeed(args)
         else:
-            self.sock.send(b'!UNKNOWN\r\n')
+            self.send(b'!UNKNOWN\r\n')
             self.logger.error(f'unknown command: req={req!r}')
         return
 
@@ -279,37 +693,119 @@ class RTSPService(TCPService):
         if self.service is not None:
             self.service.shutdown()
             self.service = None
+        if self.framed and self.scheduler is not None:
+            self.scheduler.remove(self)
         return
 
-    # startfeed: "FEED clientport path"
+    def feedframe(self, data):
+        if self.scheduler is not None:
+            self.scheduler.submit(self, data)
+        else:
+            try:
+                self.process_data(data)
+            except (OSError, ValueError) as e:
+                self.logger.error(f'feedframe: {self}: {e!r}')
+                self.shutdown()
+        return
+
+    def process_data(self, data):
+        self.logger.debug(f'process_data: {len(data)}')
+        resp = process_request(self.detector, data, self.state)
+        if resp is not None:
+            self.sendframe(resp)
+        return
+
+    # startfeed: "FEED clientport path [key=value ...]"
+    #            "FEED tcp path [key=value ...]"
+    #            "FEED shm path [key=value ...]"
+    #   options: priority=n (higher is served first, up to max_priority)
+    #            fps=n (expected frame rate)
+    #            slots=n (shm only)
+    #   replies "!BUSY retry-after n" if the server is too busy.
     def startfeed(self, args):
         self.logger.debug(f'startfeed: args={args!r}')
         flds = args.split()
         if len(flds) < 2:
-            self.sock.send(b'!INVALID\r\n')
+            self.send(b'!INVALID\r\n')
             self.logger.error(f'startfeed: invalid args: args={args!r}')
             return
         try:
-            rtp_port = int(flds[0])
+            transport = flds[0].decode('utf-8')
+            rtp_port = None
+            if transport not in ('tcp', 'shm'):
+                rtp_port = int(flds[0])
+                transport = 'udp'
             path = flds[1].decode('utf-8')
             detector = self.detectors[path]
+            opts = {}
+            for fld in flds[2:]:
+                (k,_,v) = fld.decode('utf-8').partition('=')
+                opts[k] = v
+            priority = int(opts.get('priority', 0))
+            fps = float(opts['fps']) if 'fps' in opts else None
+            nslots = int(opts.get('slots', 4))
+            if not (0 < nslots <= 64): raise ValueError(nslots)
+            if self.scheduler is not None and self.scheduler.max_priority < priority:
+                raise ValueError(priority)
         except (UnicodeError, ValueError, KeyError):
-            self.sock.send(b'!INVALID\r\n')
+            self.send(b'!INVALID\r\n')
             self.logger.error(f'startfeed: invalid args: args={args!r}')
             return
+        if self.scheduler is not None:
+            retry = self.scheduler.admit(path, fps)
+            if retry is not None:
+                self.send(f'!BUSY retry-after {retry}'.encode('ascii')+b'\r\n')
+                self.logger.info(f'startfeed: busy: path={path}, retry={retry}')
+                return
         (rtp_host, _) = self.sock.getpeername()
         # random.randbytes() is only supported in 3.9.
         session_id = bytes( random.randrange(256) for _ in range(4) )
+        if transport == 'shm':
+            self.startshm(rtp_host, session_id, detector, path, priority, fps, nslots)
+            return
+        if transport == 'tcp':
+            # Requests and responses go over this connection from now on.
+            self.logger.info(f'startfeed: tcp, rtp_host={rtp_host}, session_id={session_id.hex()}, path={path}, priority={priority}, detector={detector}')
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.send(f'+OK tcp {session_id.hex()}'.encode('ascii')+b'\r\n')
+            self.detector = detector
+            self.path = path
+            self.priority = priority
+            self.framed = True
+            if self.scheduler is not None:
+                self.scheduler.add(self, path, priority=priority, fps=fps)
+            return
         sock_rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock_rtp.setblocking(False)
         sock_rtp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock_rtp.bind(('', 0))
         (_, port) = sock_rtp.getsockname()
-        self.logger.info(f'startfeed: port={port}, rtp_host={rtp_host}, rtp_port={rtp_port}, session_id={session_id.hex()}, path={path}, detector={detector}')
+        self.logger.info(f'startfeed: port={port}, rtp_host={rtp_host}, rtp_port={rtp_port}, session_id={session_id.hex()}, path={path}, priority={priority}, detector={detector}')
         text = f'+OK {port} {session_id.hex()}'
-        self.sock.send(text.encode('ascii')+b'\r\n')
+        self.send(text.encode('ascii')+b'\r\n')
         self.service = DetectService(
-            sock_rtp, detector, rtp_host, rtp_port, session_id)
+            sock_rtp, detector, rtp_host, rtp_port, session_id,
+            path=path, priority=priority, fps=fps, scheduler=self.scheduler)
+        self.service.init()
+        self.loop.add(self.service)
+        return
+
+    def startshm(self, rtp_host, session_id, detector, path, priority, fps, nslots):
+        if rtp_host not in ('127.0.0.1', '::1'):
+            self.send(b'!INVALID\r\n')
+            self.logger.error(f'startshm: not local: rtp_host={rtp_host}')
+            return
+        sockpath = os.path.join(tempfile.gettempdir(), f'fastdet-{session_id.hex()}.sock')
+        sock_shm = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock_shm.setblocking(False)
+        sock_shm.bind(sockpath)
+        self.service = ShmService(
+            sock_shm, detector, session_id, nslots=nslots,
+            path=path, priority=priority, fps=fps, scheduler=self.scheduler)
+        (width, height) = detector.image_size
+        self.logger.info(f'startshm: shm={self.service.shm.name}, nslots={nslots}, sockpath={sockpath}, session_id={session_id.hex()}, path={path}, priority={priority}, detector={detector}')
+        text = f'+OK shm {self.service.shm.name} {nslots} {width} {height} {sockpath} {session_id.hex()}'
+        self.send(text.encode('ascii')+b'\r\n')
         self.service.init()
         self.loop.add(self.service)
         return
@@ -318,22 +814,23 @@ class RTSPService(TCPService):
 ##
 class RTSPServer(TCPServer):
 
-    def __init__(self, port, detectors):
+    def __init__(self, port, detectors, scheduler=None):
         super().__init__(port)
         self.detectors = detectors
+        self.scheduler = scheduler
         return
 
     def get_service(self, conn):
-        return RTSPService(conn, self.detectors)
+        return RTSPService(conn, self.detectors, self.scheduler)
 
 # main
 def main(argv):
     import getopt
     def usage():
-        print(f'usage: {argv[0]} [-d] [-o dbgout] [-m mode] [-s port] [-t interval] [name:num_classes:onnx]')
+        print(f'usage: {argv[0]} [-d] [-o dbgout] [-m mode] [-s port] [-t interval] [-w name:weight] [-n name:max_sessions] [-P max_priority] [-T name] [name:num_classes:onnx]')
         return 100
     try:
-        (opts, args) = getopt.getopt(argv[1:], 'do:m:s:t:')
+        (opts, args) = getopt.getopt(argv[1:], 'do:m:s:t:w:n:P:T:')
     except getopt.GetoptError:
         return usage()
     level = logging.INFO
@@ -341,12 +838,25 @@ def main(argv):
     server_port = 10000
     interval = 0.1
     dbgout = None
+    weights = {}
+    limits = {}
+    max_priority = 0
+    tiled = set()
     for (k, v) in opts:
         if k == '-d': level = logging.DEBUG
         elif k == '-o': dbgout = v
         elif k == '-m': mode = v
         elif k == '-s': server_port = int(v)
         elif k == '-t': interval = float(v)
+        elif k == '-w':
+            (name,_,weight) = v.partition(':')
+            weights[name] = float(weight)
+            if weights[name] <= 0: return usage()
+        elif k == '-n':
+            (name,_,n) = v.partition(':')
+            limits[name] = int(n)
+        elif k == '-P': max_priority = int(v)
+        elif k == '-T': tiled.add(v)
     logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=level)
 
     # Server mode.
@@ -354,13 +864,15 @@ def main(argv):
     if args:
         for arg in args:
             (name,num_classes,path) = arg.split(':')
-            detector = ONNXDetector(path, mode=mode, num_classes=int(num_classes), dbgout=dbgout)
+            detector = ONNXDetector(path, mode=mode, num_classes=int(num_classes), dbgout=dbgout,
+                                    tiled=(name in tiled))
             detectors[name] = detector
     else:
         detectors['detect'] = DummyDetector(dbgout=dbgout)
     logging.info(f'detectors={detectors}')
-    loop = EventLoop()
-    loop.add(RTSPServer(server_port, detectors))
+    scheduler = Scheduler(weights, limits, max_priority)
+    loop = EventLoop(scheduler)
+    loop.add(RTSPServer(server_port, detectors, scheduler))
     loop.run(interval)
     return 0
 